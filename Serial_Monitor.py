@@ -1,16 +1,278 @@
 #!/usr/bin/env python3
+"""
+Monitor the dome controller serial stream and fan each line out to any number of consumers.
+
+A single reader thread does blocking bulk reads from the port and publishes every complete
+line to each consumer's bounded queue. A consumer that falls behind only loses its own
+lines (counted in its drop counter); it can never stall the reader or the other consumers.
+
+Consumers:
+ - stdout
+ - a rotating text log
+ - local TCP subscribers: any program can connect to 127.0.0.1:<port> to receive the stream.
+   Commands a subscriber sends are written to the controller one at a time, so control tools (rotate.py,
+   dome_control.py, sequence.py via lib.open_dome_connection) share the port through the
+   monitor instead of competing with it for the controller's output.
+
+Examples:
+    ./Serial_Monitor.py
+    ./Serial_Monitor.py --log-file debug_logs/dome_serial.log --port 5055
+    nc 127.0.0.1 5055
+"""
+import argparse
+import datetime
+import logging
+import logging.handlers
+import os
+from pathlib import Path
+import queue
+import select
+import socketserver
+import threading
 
-import time
 import serial
 
-raise NotImplementedError('Serial Monitor Integration Not Implemented')
+from lib import *
+
+DEFAULT_QUEUE_SIZE = 1024
+DEFAULT_LOG_FILE = 'debug_logs/dome_serial.log'
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+READ_CHUNK_SIZE = 4096
+SHUTDOWN_TIMEOUT_SEC = 5  # Time allowed for consumers to drain their queues on exit.
+# A subscriber's unterminated bytes are treated as one command after this long without more data.
+COMMAND_IDLE_SEC = 0.2
+
+
+class Subscriber:
+    """Bounded queue of (utc_timestamp, line) tuples for one consumer."""
+
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.delivered = 0  # Lines taken from the queue by the consumer
+        self.dropped = 0
+
+    def offer(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def get(self):
+        """Block until the next item is available. Returns None once the stream is closed."""
+        item = self.queue.get()
+        if item is not None:
+            self.delivered += 1
+        return item
+
+    def close(self, timeout):
+        """Queue the end-of-stream marker after any queued lines, waiting up to timeout for space."""
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+
+
+class LineFanout:
+    """Deliver each published line to every subscriber without ever blocking the publisher."""
+
+    def __init__(self, queue_size=DEFAULT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, name):
+        sub = Subscriber(name, self.queue_size)
+        with self._lock:
+            self._subscribers.append(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            if sub in self._subscribers:
+                self._subscribers.remove(sub)
+
+    def publish(self, item):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for sub in subscribers:
+            sub.offer(item)
+
+    def close(self, timeout=SHUTDOWN_TIMEOUT_SEC):
+        """Mark the end of the stream for every consumer once it has consumed its queued lines."""
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for sub in subscribers:
+            sub.close(timeout)
+
+    def stats(self):
+        with self._lock:
+            return [(sub.name, sub.delivered, sub.dropped) for sub in self._subscribers]
+
+
+def read_lines(ser: serial.Serial, fanout: LineFanout, stop: threading.Event):
+    """
+    Read the serial stream in bulk and publish each complete line to fanout.
+
+    ser.read blocks (up to ser.timeout) until at least one byte arrives, then everything
+    already buffered by the driver is taken in the same call.
+    """
+    buf = b''
+    while not stop.is_set():
+        chunk = ser.read(max(1, min(ser.in_waiting, READ_CHUNK_SIZE)))
+        if not chunk:
+            continue
+        buf += chunk
+        *raw_lines, buf = buf.split(b'\n')
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for raw in raw_lines:
+            line = raw.decode('ascii', errors='replace').rstrip('\r')
+            if line:
+                fanout.publish((now, line))
+
+
+""" Consumers """
+
+
+def stdout_consumer(sub: Subscriber):
+    while (item := sub.get()) is not None:
+        print(item[1], flush=True)
+
+
+def log_consumer(sub: Subscriber, log_file):
+    """Append each line with its UTC timestamp to a size-rotated text log."""
+    os.makedirs(Path(log_file).parent, exist_ok=True)
+    handler = logging.handlers.RotatingFileHandler(
+        log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT
+    )
+    logger = logging.getLogger('dome_serial')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    try:
+        while (item := sub.get()) is not None:
+            timestamp, line = item
+            logger.info(f'{timestamp.isoformat()} {line}')
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+
+
+class SubscriberHandler(socketserver.BaseRequestHandler):
+    """
+    Stream every line to one connected TCP client until it disconnects, and write anything
+    the client sends to the controller.
+    """
+
+    def write_command(self, cmd: bytes):
+        cmd = cmd.strip()
+        if cmd:
+            with self.server.write_lock:
+                self.server.ser.write(cmd + b'\n')
+
+    def forward_commands(self, sub: Subscriber):
+        """
+        Split the client's bytes into commands and write each one to the controller whole and
+        newline-terminated, so commands from different clients are never merged by the firmware.
+        """
+        buf = b''
+        try:
+            while True:
+                ready, _, _ = select.select([self.request], [], [], COMMAND_IDLE_SEC if buf else None)
+                if not ready:  # Unterminated command from a client that does not send newlines
+                    self.write_command(buf)
+                    buf = b''
+                    continue
+                data = self.request.recv(1024)
+                if not data:
+                    break
+                *cmds, buf = (buf + data).split(b'\n')
+                for cmd in cmds:
+                    self.write_command(cmd)
+            self.write_command(buf)
+        except (OSError, serial.SerialException):
+            pass
+        sub.close(0)  # Wake handle() so the subscription ends with the connection.
+
+    def handle(self):
+        fanout = self.server.fanout
+        sub = fanout.subscribe(f'socket {self.client_address[0]}:{self.client_address[1]}')
+        print(f'\tSubscriber connected: {sub.name}')
+        start_thread(self.forward_commands, sub)
+        try:
+            while (item := sub.get()) is not None:
+                self.request.sendall(str.encode(item[1] + '\n'))
+        except OSError:
+            pass
+        finally:
+            fanout.unsubscribe(sub)
+            print(f'\tSubscriber disconnected: {sub.name} (dropped {sub.dropped} lines)')
+
+
+class SubscriberServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port, fanout: LineFanout, ser: serial.Serial):
+        super().__init__(('127.0.0.1', port), SubscriberHandler)
+        self.fanout = fanout
+        self.ser = ser
+        self.write_lock = threading.Lock()
+
+
+def start_thread(target, *args):
+    t = threading.Thread(target=target, args=args, daemon=True)
+    t.start()
+    return t
+
+
+def print_stats(fanout: LineFanout):
+    print('\nConsumer statistics:')
+    for name, delivered, dropped in fanout.stats():
+        print(f'\t{name:<28} delivered {delivered:>9}  dropped {dropped:>7}')
+
+
+def monitor_cli_main():
+    parser = argparse.ArgumentParser(description="Monitor the Crocker dome controller serial stream.")
+    parser.add_argument('--log-file', default=DEFAULT_LOG_FILE, help='Rotating text log of every line received.')
+    parser.add_argument('--no-log', action='store_true', help='Do not write the text log.')
+    parser.add_argument('--no-stdout', action='store_true', help='Do not print lines to stdout.')
+    parser.add_argument('--port', type=int,
+                        help='Local TCP port for subscribers (default: monitor_port in the config). Use 0 to disable.')
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE,
+                        help='Maximum number of buffered lines per consumer before lines are dropped.')
+    args = parser.parse_args()
+
+    config = load_config()
+    port = config.get('monitor_port', 0) if args.port is None else args.port
+    fanout = LineFanout(args.queue_size)
+    consumers = []
+    if not args.no_stdout:
+        consumers.append(start_thread(stdout_consumer, fanout.subscribe('stdout')))
+    if not args.no_log:
+        consumers.append(start_thread(log_consumer, fanout.subscribe(f'log {args.log_file}'), args.log_file))
 
-domeData=serial.Serial('/dev/ttyUSB_DOME', baudrate=9600, timeout=1)
-time.sleep(1)
+    stop = threading.Event()
+    with serial.Serial(config['dome_controller_device_file'], baudrate=config['baudrate'], timeout=1,
+                       write_timeout=SERIAL_WRITE_TIMEOUT) as ser:
+        server = None
+        if port:
+            server = SubscriberServer(port, fanout, ser)
+            start_thread(server.serve_forever)
+            print(f'Serving subscribers on 127.0.0.1:{port}')
+        try:
+            read_lines(ser, fanout, stop)
+        except KeyboardInterrupt:
+            stop.set()
+        finally:
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+            fanout.close()
+            for t in consumers:
+                t.join(SHUTDOWN_TIMEOUT_SEC)
+            print_stats(fanout)
 
-while True:
-    while domeData.in_waiting==0:
-        pass
-    dataPacket=domeData.readline().decode('ascii')
-    print(dataPacket)
-    
+if __name__ == '__main__':
+    monitor_cli_main()
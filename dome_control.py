@@ -47,12 +47,7 @@ def do_scheduled_rotation(action):
         print(f"\tStarted at \t{start_time}")
         print('\tSIMULATING ROTATION')
         time.sleep(2)
-        with serial.Serial(
-                dome_controller_device_file,
-                baudrate=baudrate,
-                timeout=1,
-                write_timeout=SERIAL_WRITE_TIMEOUT
-        ) as ser:
+        with open_dome_connection(config) as ser:
             try:
                 print('\tSending action')
                 # auto_rotate_to_azimuth(ser, )
@@ -131,12 +126,7 @@ def cleanup(stop_rotation=False, verbose=True):
     if stop_rotation:
         try:
             print('\tStopping any dome rotation...')
-            with serial.Serial(
-                    dome_controller_device_file,
-                    baudrate=baudrate,
-                    timeout=1,
-                    write_timeout=SERIAL_WRITE_TIMEOUT
-            ) as ser:
+            with open_dome_connection(config) as ser:
                 stop_rotation(ser)
             print('\tSuccess')
         except serial.SerialException:
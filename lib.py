@@ -5,8 +5,12 @@ Utility routines for the dome control program.
 import os
 from pathlib import Path
 import json
+import select
+import socket
+import time
 import numpy as np
 import pandas as pd
+import serial
 
 config_fname = 'crocker_control_config.json'
 
@@ -18,10 +22,136 @@ RETRY_INTERVAL_SEC = 10
 
 # Create
 
+def parse_az_line(line: str):
+    """
+    Parse a line sent by the dome controller.
+
+    :return: azimuth angle if this is an "Azimuth = N" or "RDP = N" line and None otherwise.
+    """
+    lower = line.lower()
+    if ("az" in lower or "rdp" in lower) and "=" in lower:
+        try:
+            return float(lower.split("=")[1])
+        except ValueError:
+            return None
+    return None
+
+
+def az_distance(az1, az2):
+    """Smallest angular distance in degrees between az1 and az2."""
+    return abs((az1 - az2 + 180) % 360 - 180)
+
+
+def arc_length(from_az, to_az, rot_dir):
+    """Degrees rotated going from from_az to to_az in direction rot_dir ('right' increases az)."""
+    if rot_dir == 'right':
+        return (to_az - from_az) % 360
+    return (from_az - to_az) % 360
+
+
 def load_config():
     with open(config_fname, 'r') as fp:
         return json.load(fp)
 
+
+def send_command(ser, cmd: str):
+    """
+    Write one newline-terminated command to the dome controller.
+
+    The newline ends the firmware's readStringUntil immediately, and lets Serial_Monitor.py
+    keep commands from different programs apart.
+    """
+    ser.write(str.encode(cmd + '\n'))
+
+
+class MonitorClient:
+    """
+    Serial-port-like connection to the dome controller through a running Serial_Monitor.py.
+
+    Bytes written are forwarded to the controller by the monitor, and every line the controller
+    sends is received from the monitor's fan-out, so control tools never open the port themselves.
+    Supports the subset of serial.Serial used by the control scripts.
+    """
+
+    def __init__(self, sock: socket.socket, timeout=1):
+        self.sock = sock
+        self.timeout = timeout
+        self._buf = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _fill(self, timeout):
+        """Receive whatever is available within timeout seconds into the input buffer."""
+        ready, _, _ = select.select([self.sock], [], [], timeout)
+        if not ready:
+            return
+        try:
+            data = self.sock.recv(4096)
+        except OSError as ex:
+            raise serial.SerialException(f'Serial monitor connection error: {ex}')
+        if not data:
+            raise serial.SerialException('Serial monitor closed the connection')
+        self._buf += data
+
+    @property
+    def in_waiting(self):
+        self._fill(0)
+        return len(self._buf)
+
+    def readline(self):
+        """Return the next line, or whatever has arrived if no full line arrives within timeout."""
+        deadline = time.monotonic() + self.timeout
+        while b'\n' not in self._buf:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self._fill(remaining)
+        end = self._buf.find(b'\n') + 1 or len(self._buf)
+        line = bytes(self._buf[:end])
+        del self._buf[:end]
+        return line
+
+    def write(self, data):
+        try:
+            self.sock.sendall(data)
+        except OSError as ex:
+            raise serial.SerialException(f'Serial monitor connection error: {ex}')
+        return len(data)
+
+    def reset_input_buffer(self):
+        while self.in_waiting:
+            self._buf.clear()
+
+    def close(self):
+        self.sock.close()
+
+
+def open_dome_connection(config, timeout=1):
+    """
+    Open a connection to the dome controller.
+
+    Goes through Serial_Monitor.py if one is listening on config['monitor_port'], since only one
+    program can read the serial port without losing data. Otherwise opens the port directly.
+    """
+    monitor_port = config.get('monitor_port')
+    if monitor_port:
+        try:
+            sock = socket.create_connection(('127.0.0.1', monitor_port), timeout=timeout)
+            sock.settimeout(None)
+            return MonitorClient(sock, timeout=timeout)
+        except OSError:
+            pass
+    return serial.Serial(
+        config['dome_controller_device_file'],
+        baudrate=config['baudrate'],
+        timeout=timeout,
+        write_timeout=SERIAL_WRITE_TIMEOUT
+    )
+
 def validate_obs_plan(obs_plan_df: pd.DataFrame):
     """
     Check that obs_plan_df has the form we expect
@@ -53,3 +183,15 @@ def load_obs_plan(config):
     obs_plan_loaded_df = obs_plan_loaded_df.sort_values(by='utc_timestamp')
     validate_obs_plan(obs_plan_loaded_df)
     return obs_plan_loaded_df
+
+
+def load_az_obs_plan(obs_plan_path):
+    """Load an obs plan of target azimuth angles, as generated in obs_plan_eda.ipynb."""
+    obs_plan_df = pd.read_csv(obs_plan_path, index_col=0)
+    if not {'utc_timestamp', 'target_azimuth_angle'} <= set(obs_plan_df.columns):
+        raise ValueError(f"obs plan must have 'utc_timestamp' and 'target_azimuth_angle' columns: {obs_plan_df.columns}")
+    obs_plan_df['utc_timestamp'] = pd.to_datetime(obs_plan_df['utc_timestamp'], utc=True)
+    obs_plan_df = obs_plan_df.sort_values(by='utc_timestamp')
+    if np.any((obs_plan_df['target_azimuth_angle'] < 0) | (obs_plan_df['target_azimuth_angle'] >= 360)):
+        raise ValueError("obs plan contains azimuth angles outside 0 <= az < 360")
+    return obs_plan_df
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Wear-aware planning of dome moves for an observing plan.
+
+Moves are modelled the way auto_rotate_to_azimuth carries them out: a request closer than
+az_error_tol is skipped, otherwise the dome rotates for
+max(MIN_ROTATION_DURATION_SEC, (distance - az_error_tol) / ROTATION_RATE_DEG_PER_SEC) seconds
+(so at least ~4 deg and stopping az_error_tol short of the request), then coasts
+ROTATION_COAST_DEG. Each move also pays the fixed waits in auto_rotate_to_azimuth and the
+firmware's 1 s relay delay on every start. Every motor start and change of direction also
+costs contactor wear; reversals cost wear only, no extra time.
+
+For each target the optimizer picks one of:
+ - hold: the dome is already within tolerance, so no move is made,
+ - a move: the requested azimuth and direction to pass to auto_rotate_to_azimuth so that the
+   dome lands within tolerance of the target, possibly by continuing in the same direction
+   instead of reversing,
+ - skip: stay put while off target until the next target. This is only worth it for short
+   excursions, e.g. when the following target comes back toward the current position.
+
+It minimizes, over the whole plan with dynamic programming,
+
+    seconds off target (moving or skipped) + starts * START_WEAR_COST_SEC + reversals * REVERSAL_WEAR_COST_SEC
+
+The projected savings compare against auto_rotate_to_azimuth's shortest-arc behaviour under the
+same model. ROTATION_COAST_DEG and the wear costs are estimates; check them against the dome.
+
+Example:
+    ./move_optimizer.py obs_plans/SAMPLE_az_obsplan.csv --initial-az 270 --out obs_plans/optimized.csv
+"""
+import argparse
+import math
+
+import numpy as np
+import pandas as pd
+
+from lib import *
+from rotate import (MAX_ROTATION_DURATION_SEC, MIN_ROTATION_DURATION_SEC, ROTATION_RATE_DEG_PER_SEC,
+                    ROTATION_COAST_DEG)
+
+# Fixed waits in auto_rotate_to_azimuth: 2 s before stopping, 2 s in stop_rotation, 4 s stop check.
+MOVE_OVERHEAD_SEC = 8
+START_TIME_SEC = 1  # Firmware delay(1000) toggling the opposite relay before every start
+# Contactor wear expressed as an equivalent number of seconds off target.
+START_WEAR_COST_SEC = 5
+REVERSAL_WEAR_COST_SEC = 10
+
+MIN_ROTATION_DEG = MIN_ROTATION_DURATION_SEC * ROTATION_RATE_DEG_PER_SEC
+EPS = 1e-9
+
+
+def step_az(az, deg, rot_dir):
+    return (az + deg) % 360 if rot_dir == 'right' else (az - deg) % 360
+
+
+def executed_move(curr_az, commanded_az, rot_dir, az_error_tol):
+    """
+    Model auto_rotate_to_azimuth(ser, commanded_az, az_error_tol, rot_dir=rot_dir).
+
+    :return: (end azimuth angle, rotation duration in seconds), or None if no move is made.
+    :raises ValueError: if the rotation is too long for rotate_*_nsec_and_stop.
+    """
+    if az_distance(curr_az, commanded_az) < az_error_tol:
+        return None
+    angular_dist = arc_length(curr_az, commanded_az, rot_dir)
+    rot_duration = max(MIN_ROTATION_DURATION_SEC, (angular_dist - az_error_tol) / ROTATION_RATE_DEG_PER_SEC)
+    if rot_duration >= MAX_ROTATION_DURATION_SEC:
+        raise ValueError(f'rotation of {angular_dist} deg exceeds MAX_ROTATION_DURATION_SEC')
+    end_az = step_az(curr_az, rot_duration * ROTATION_RATE_DEG_PER_SEC + ROTATION_COAST_DEG, rot_dir)
+    return end_az, rot_duration
+
+
+def command_for_landing(curr_az, end_az, rot_dir, az_error_tol):
+    """
+    Inverse of executed_move: the azimuth to request so the dome lands on end_az.
+
+    :return: (commanded azimuth angle, rotation duration in seconds), or None if no request lands there.
+    """
+    rotation = arc_length(curr_az, end_az, rot_dir) - ROTATION_COAST_DEG
+    if abs(rotation - MIN_ROTATION_DEG) < EPS:
+        angular_dist = MIN_ROTATION_DEG + az_error_tol  # Any shorter request also gives the minimum rotation
+    elif rotation > MIN_ROTATION_DEG:
+        angular_dist = rotation + az_error_tol
+    else:
+        return None
+    rot_duration = (angular_dist - az_error_tol) / ROTATION_RATE_DEG_PER_SEC
+    if rot_duration >= MAX_ROTATION_DURATION_SEC or min(angular_dist, 360 - angular_dist) < az_error_tol:
+        return None
+    return step_az(curr_az, angular_dist, rot_dir), max(MIN_ROTATION_DURATION_SEC, rot_duration)
+
+
+def move_time_sec(rot_duration):
+    return rot_duration + MOVE_OVERHEAD_SEC + START_TIME_SEC
+
+
+def move_cost(rot_duration, rot_dir, last_dir):
+    reversal = last_dir is not None and rot_dir != last_dir
+    return move_time_sec(rot_duration) + START_WEAR_COST_SEC + REVERSAL_WEAR_COST_SEC * reversal
+
+
+def tolerance_window(target_az, az_error_tol):
+    """
+    Whole-degree positions within az_error_tol of target_az (the controller reports whole degrees).
+
+    :raises ValueError: if no whole degree lies within az_error_tol of target_az.
+    """
+    center = round(target_az)
+    span = math.ceil(az_error_tol)
+    window = [(center + k) % 360 for k in range(-span, span + 1)
+              if az_distance((center + k) % 360, target_az) < az_error_tol]
+    if not window:
+        raise ValueError(f'no whole-degree azimuth lies within {az_error_tol} deg of {target_az}')
+    return window
+
+
+def get_night(timestamps):
+    """Night each UTC timestamp belongs to. Nights at Crocker fall within a single UTC date."""
+    return pd.Series(timestamps).dt.date.rename('night')
+
+
+def get_dwell_times(timestamps):
+    """
+    Seconds from each target until the next one on the same night. The last target of each
+    night gets that night's median interval (or the median over all nights for a single target).
+    """
+    timestamps = pd.Series(timestamps).reset_index(drop=True)
+    night = get_night(timestamps)
+    dwell = timestamps.groupby(night).transform(lambda t: t.diff().shift(-1)).dt.total_seconds()
+    night_median = dwell.groupby(night).transform('median')
+    overall_median = dwell.median() if dwell.notna().any() else 0
+    return list(dwell.fillna(night_median).fillna(overall_median))
+
+
+def baseline_moves(targets, initial_az, az_error_tol=2):
+    """
+    Moves made by auto_rotate_to_azimuth(ser, target_az, az_error_tol) for each target in turn.
+
+    :return: list of (direction, commanded_az, end_az, rot_duration) with direction 'right',
+        'left', 'hold' or 'failed' (rotation too long for rotate.py).
+    """
+    moves = []
+    curr_az = round(initial_az)
+    for target_az in targets:
+        rot_dir = 'right' if arc_length(curr_az, target_az, 'right') < arc_length(curr_az, target_az, 'left') else 'left'
+        try:
+            result = executed_move(curr_az, target_az, rot_dir, az_error_tol)
+        except ValueError:
+            moves.append(('failed', target_az, curr_az, 0))
+            continue
+        if result is None:
+            moves.append(('hold', np.nan, curr_az, 0))
+            continue
+        curr_az, rot_duration = result
+        moves.append((rot_dir, target_az, curr_az, rot_duration))
+    return moves
+
+
+def optimize_moves(targets, dwell_times, initial_az, az_error_tol=2):
+    """
+    Choose hold, skip or a move for every target to minimize total cost over the plan.
+
+    The state after each target is (dome position, direction of the last move).
+
+    :param targets: target azimuth angles in the order they must be reached.
+    :param dwell_times: seconds each target is observed for, i.e. the cost of skipping it.
+    :param initial_az: azimuth angle of the dome before the first move.
+    :param az_error_tol: max angular error between each target and the dome position.
+    :return: list of (direction, commanded_az, end_az, rot_duration) with direction 'right',
+        'left', 'hold' or 'skip'.
+    """
+    # state -> (cost, previous state, move)
+    states = {(round(initial_az), None): (0.0, None, None)}
+    history = []
+    for target_az, dwell in zip(targets, dwell_times):
+        window = tolerance_window(target_az, az_error_tol)
+        next_states = {}
+
+        def relax(state, cost, prev_state, move):
+            if state not in next_states or cost < next_states[state][0]:
+                next_states[state] = (cost, prev_state, move)
+
+        for (curr_az, last_dir), (cost, _, _) in states.items():
+            if az_distance(curr_az, target_az) < az_error_tol:
+                relax((curr_az, last_dir), cost, (curr_az, last_dir), ('hold', np.nan, curr_az, 0))
+            else:
+                relax((curr_az, last_dir), cost + dwell, (curr_az, last_dir), ('skip', np.nan, curr_az, 0))
+            for end_az in window:
+                for rot_dir in ('right', 'left'):
+                    command = command_for_landing(curr_az, end_az, rot_dir, az_error_tol)
+                    if command is None:
+                        continue
+                    commanded_az, rot_duration = command
+                    relax((end_az, rot_dir), cost + move_cost(rot_duration, rot_dir, last_dir),
+                          (curr_az, last_dir), (rot_dir, commanded_az, end_az, rot_duration))
+        history.append(next_states)
+        states = next_states
+
+    # Walk back from the cheapest final state.
+    state = min(states, key=lambda s: states[s][0])
+    moves = []
+    for step_states in reversed(history):
+        _, prev_state, move = step_states[state]
+        moves.append(move)
+        state = prev_state
+    return moves[::-1]
+
+
+def moves_to_df(obs_plan_df, moves, dwell_times, az_error_tol):
+    """Return obs_plan_df with the direction, requested azimuth, predicted end azimuth and cost of each move."""
+    df = obs_plan_df[['utc_timestamp', 'target_azimuth_angle']].copy()
+    df['direction'] = [m[0] for m in moves]
+    df['commanded_azimuth_angle'] = [m[1] for m in moves]
+    df['end_azimuth_angle'] = [m[2] for m in moves]
+    df['start'] = df['direction'].isin(['right', 'left'])
+    rot_dirs = df['direction'].where(df['start']).ffill()
+    df['reversal'] = df['start'] & rot_dirs.shift().notna() & (rot_dirs != rot_dirs.shift())
+    df['rotation_deg'] = [m[3] * ROTATION_RATE_DEG_PER_SEC + ROTATION_COAST_DEG if m[3] else 0 for m in moves]
+    df['move_time_sec'] = [move_time_sec(m[3]) if start else 0 for m, start in zip(moves, df['start'])]
+    df['on_target'] = [az_distance(end_az, target_az) < az_error_tol
+                       for end_az, target_az in zip(df['end_azimuth_angle'], df['target_azimuth_angle'])]
+    df['off_target_sec'] = np.where(df['on_target'], df['move_time_sec'], dwell_times)
+    return df
+
+
+def summarize(moves_df):
+    """Per-night totals of a moves DataFrame. Nights are grouped by UTC date."""
+    night = get_night(moves_df['utc_timestamp']).set_axis(moves_df.index)
+    return moves_df.groupby(night).agg(
+        targets=('target_azimuth_angle', 'size'),
+        missed=('on_target', lambda on_target: (~on_target).sum()),
+        starts=('start', 'sum'),
+        reversals=('reversal', 'sum'),
+        rotation_deg=('rotation_deg', 'sum'),
+        move_time_sec=('move_time_sec', 'sum'),
+        off_target_sec=('off_target_sec', 'sum'),
+    )
+
+
+def move_optimizer_cli_main():
+    parser = argparse.ArgumentParser(description="Plan dome moves that minimize motor starts and direction reversals.")
+    parser.add_argument('obs_plan', help='CSV obs plan with utc_timestamp and target_azimuth_angle columns.')
+    parser.add_argument('--initial-az', type=float, required=True, help='Dome azimuth angle before the first move.')
+    parser.add_argument('--tol', type=float, default=2, help='az_error_tol passed to auto_rotate_to_azimuth.')
+    parser.add_argument('--out', help='Write the optimized moves to this CSV file.')
+    args = parser.parse_args()
+
+    obs_plan_df = load_az_obs_plan(args.obs_plan)
+    targets = list(obs_plan_df['target_azimuth_angle'])
+    dwell_times = get_dwell_times(obs_plan_df['utc_timestamp'])
+    baseline_df = moves_to_df(obs_plan_df, baseline_moves(targets, args.initial_az, args.tol), dwell_times, args.tol)
+    optimized_df = moves_to_df(
+        obs_plan_df, optimize_moves(targets, dwell_times, args.initial_az, args.tol), dwell_times, args.tol
+    )
+
+    baseline, optimized = summarize(baseline_df), summarize(optimized_df)
+    print('auto_rotate_to_azimuth shortest-arc moves (current behaviour):')
+    print(baseline.to_string())
+    print('\nOptimized moves:')
+    print(optimized.to_string())
+    print(f'\nProjected savings per night (assuming {ROTATION_COAST_DEG} deg coast after each stop):')
+    print((baseline - optimized).drop(columns='targets').to_string())
+
+    if args.out:
+        optimized_df.to_csv(args.out)
+        print(f'\nWrote optimized moves to {args.out}')
+
+
+if __name__ == "__main__":
+    move_optimizer_cli_main()
@@ -19,6 +19,12 @@ from serial.serialutil import SerialTimeoutException
 from lib import *
 
 MAX_ROTATION_DURATION_SEC = 20
+MIN_ROTATION_DURATION_SEC = 2
+ROTATION_RATE_DEG_PER_SEC = 2
+ROTATION_COAST_DEG = 1  # Estimated rotation after the stop command
+# Start / stop commands for each rotation direction, as accepted by the deployed dome controller
+# (see debug_logs/2024_10_22.txt). "Right" increases the azimuth angle.
+ROTATION_COMMANDS = {'right': ('DRO', 'DRo'), 'left': ('DLO', 'DLo')}
 MIN_AZ_DIFF = 3
 
 """ Auto move to a particular azimuth angle. """
@@ -70,17 +76,17 @@ def read_az_packet(ser: serial.Serial, ):
             print(f'FAILED to read packet!\n\tUnicodeDecodeError: {ude},\n\tpacket_data: {packet_data}')
             return None
         # An azimuth packet looks like "Azimuth = {NUM}". Ignore other packets
-        if "az" in packet_data.lower() or "rdp" in packet_data.lower():
-            curr_az = float(packet_data.lower().split("=")[1])
-            return curr_az
+        return parse_az_line(packet_data)
 
 
-def auto_rotate_to_azimuth(ser: serial.Serial, target_az, az_error_tol=2, from_cmd_line=False):
+def auto_rotate_to_azimuth(ser: serial.Serial, target_az, az_error_tol=2, from_cmd_line=False, rot_dir=None):
     """
 
     :param ser: Open serial port to the dome controller device.
     :param target_az: azimuth angle the dome should be rotated to.
     :param az_error_tol: max angular error between target_az and final azimuth angle.
+    :param rot_dir: 'left' or 'right' to force the rotation direction (e.g. as planned by move_optimizer.py).
+        If None, the direction requiring less rotation is used.
     :return: final azimuth angle.
     """
     initial_az = get_curr_az(ser, from_cmd_line=from_cmd_line)
@@ -94,14 +100,13 @@ def auto_rotate_to_azimuth(ser: serial.Serial, target_az, az_error_tol=2, from_c
     # Determine which direction requires the less rotation
     az_diff_rot_right = abs((target_az - initial_az) % 360)
     az_diff_rot_left = abs((initial_az - target_az) % 360)
-    if az_diff_rot_right < az_diff_rot_left:
-        rot_dir = 'right'
-        angular_dist = az_diff_rot_right
-    else:
-        rot_dir = 'left'
-        angular_dist = az_diff_rot_left
+    if rot_dir is None:
+        rot_dir = 'right' if az_diff_rot_right < az_diff_rot_left else 'left'
+    elif rot_dir not in ('left', 'right'):
+        raise ValueError(f"rot_dir must be 'left', 'right' or None, not {rot_dir}")
+    angular_dist = az_diff_rot_right if rot_dir == 'right' else az_diff_rot_left
     # Do no rotation if current dome position is close enough to target_az
-    if angular_dist < az_error_tol:
+    if min(az_diff_rot_right, az_diff_rot_left) < az_error_tol:
         print(f"Distance between target_az and current az is within the dome's minimum angular rotation step: {az_error_tol} deg.")
         return initial_az
 
@@ -113,7 +118,7 @@ def auto_rotate_to_azimuth(ser: serial.Serial, target_az, az_error_tol=2, from_c
 
     # Start rotation
     print(f"Starting dome rotation: {rot_dir.upper()} {angular_dist} degrees")
-    rot_duration = max(2, (angular_dist - az_error_tol) / 2)
+    rot_duration = max(MIN_ROTATION_DURATION_SEC, (angular_dist - az_error_tol) / ROTATION_RATE_DEG_PER_SEC)
     print('Rotating dome for {0} seconds'.format(rot_duration))
     if rot_dir == 'right':
         rotate_right_nsec_and_stop(ser, rot_duration)
@@ -164,7 +169,7 @@ def get_curr_az(ser: serial.Serial, listen_timeout = 10, return_on_first_az=True
     """Queries the dome controller and returns its current azimuth angle."""
     if from_cmd_line:
         time.sleep(2)
-    ser.write(str.encode("RDP"))
+    send_command(ser, "RDP")
     az_angles = []
     start_time = datetime.datetime.now(datetime.timezone.utc)
     curr_time = datetime.datetime.now(datetime.timezone.utc)
@@ -199,9 +204,9 @@ def rotate_left_nsec_and_stop(ser: serial.Serial, n: int):
     if not 0 <= n < MAX_ROTATION_DURATION_SEC:
         raise ValueError('n was {0} must be between 0 and {1}'.format(n, MAX_ROTATION_DURATION_SEC))
 
-    ser.write(str.encode('DLO'))
+    send_command(ser, ROTATION_COMMANDS['left'][0])
     time.sleep(n)
-    ser.write(str.encode('DLo'))
+    send_command(ser, ROTATION_COMMANDS['left'][1])
 
 
 def rotate_right_nsec_and_stop(ser: serial.Serial, n: int):
@@ -215,9 +220,9 @@ def rotate_right_nsec_and_stop(ser: serial.Serial, n: int):
     """
     if not 0 <= n < MAX_ROTATION_DURATION_SEC:
         raise ValueError('n was {0} must be between 0 and {1}'.format(n, MAX_ROTATION_DURATION_SEC))
-    ser.write(str.encode('DRO'))
+    send_command(ser, ROTATION_COMMANDS['right'][0])
     time.sleep(n)
-    ser.write(str.encode('DRo'))
+    send_command(ser, ROTATION_COMMANDS['right'][1])
 
 
 """ Manually start & stop dome rotation """
@@ -231,7 +236,7 @@ def start_rotate_left(ser: serial.Serial):
     :param ser: open serial connection to the dome controller.
     :raises SerialTimeoutException: if the command cannot be sent through the provided serial port
     """
-    ser.write(str.encode('DLO'))
+    send_command(ser, ROTATION_COMMANDS['left'][0])
 
 
 def start_rotate_right(ser: serial.Serial):
@@ -242,7 +247,7 @@ def start_rotate_right(ser: serial.Serial):
     :param ser: open serial connection to the dome controller.
     :raises SerialTimeoutException: if the command cannot be sent through the provided serial port
     """
-    ser.write(str.encode('DRO'))
+    send_command(ser, ROTATION_COMMANDS['right'][0])
 
 
 def stop_rotation(ser: serial.Serial, direction='both'):
@@ -254,15 +259,15 @@ def stop_rotation(ser: serial.Serial, direction='both'):
     :raises SerialTimeoutException: if the command cannot be sent through the provided serial port.
     """
     if direction == 'right':
-        ser.write(str.encode('DRo'))
+        send_command(ser, ROTATION_COMMANDS['right'][1])
         time.sleep(2)
     elif direction == 'left':
-        ser.write(str.encode('DLo'))
+        send_command(ser, ROTATION_COMMANDS['left'][1])
         time.sleep(2)
     else:
-        ser.write(str.encode('DRo'))
+        send_command(ser, ROTATION_COMMANDS['right'][1])
         time.sleep(2)
-        ser.write(str.encode('DLo'))
+        send_command(ser, ROTATION_COMMANDS['left'][1])
 
 
 """ CLI routines"""
@@ -277,9 +282,7 @@ def do_rotation_command(args):
     # Open serial port (as specified in the config file) then do requested command.
     cmd = args.cmd
     config = load_config()
-    dome_controller_device_file = config['dome_controller_device_file']
-    baudrate = config['baudrate']
-    with serial.Serial(dome_controller_device_file, baudrate=baudrate, timeout=1, write_timeout=SERIAL_WRITE_TIMEOUT) as ser:
+    with open_dome_connection(config) as ser:
     # with open('crocker_control_config.json', 'r') as ser:
         try:
             if cmd == 'left2sec':
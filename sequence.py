@@ -0,0 +1,505 @@
+#!/usr/bin/env python3
+"""
+Run named dome, shutter, light and fan command sequences.
+
+Sequences are defined in the JSON file given by the "sequence_file" config key. Each step
+sends one command to the dome controller and may then wait on a real status condition
+(an azimuth report or a matching reply to a status query). Steps without a dependency
+between them run concurrently; the only ordering imposed is a per-channel lock so that
+commands for the local relays and the HC-12 radio pass-through to the shutter controller
+are each written one at a time. If any step fails, no new steps are started and the
+sequence's "abort" commands are sent.
+
+Sequences marked "verified": false depend on controller replies whose format has not been
+checked against the hardware and are only run with --unverified.
+
+Examples:
+    ./sequence.py list
+    ./sequence.py run open_for_night --dry-run
+    ./sequence.py run close_for_night
+    ./sequence.py run open_for_night --unverified
+"""
+import argparse
+import collections
+import datetime
+import json
+import re
+import threading
+import time
+
+import serial
+
+from lib import *
+from rotate import ROTATION_COMMANDS, ROTATION_COAST_DEG
+
+# Commands the firmware forwards over the HC-12 radio to the shutter controller.
+RADIO_COMMANDS = {
+    'WD1R', 'WD2R', 'LO', 'Lo', 'FO', 'Fo', 'USO', 'USC', 'LSO', 'LSC', 'RFO', 'RFC', 'CAP',
+    'CLS', 'USS', 'LSS', 'BSS', 'RUP', 'RLP', 'RBV', 'RCV', 'RSC'
+}
+CHANNELS = ('relay', 'radio')
+# Minimum spacing between consecutive writes on a channel. The radio link drops commands
+# that arrive back-to-back at the shutter controller.
+CHANNEL_MIN_GAP_SEC = {'relay': 0.0, 'radio': 0.5}
+
+# Fail a rotation once the dome has moved this far away from the target.
+WRONG_WAY_DEG = 3
+# After a stop, wait STOP_SETTLE_SEC for the dome to coast to a halt (as stop_rotation does),
+# then it must send no azimuth reports for STOP_CHECK_SEC to count as stopped.
+STOP_SETTLE_SEC = 2
+STOP_CHECK_SEC = 4
+STOP_RETRY_ATTEMPTS = 3
+
+PORT_SETTLE_SEC = 2  # The controller resets when the port is opened.
+LINE_HISTORY_LEN = 256
+DEFAULT_WAIT_TIMEOUT_SEC = 60
+DEFAULT_POLL_SEC = 5
+
+VALID_SEQUENCE_KEYS = {'description', 'steps', 'abort', 'verified'}
+VALID_STEP_KEYS = {'name', 'cmd', 'channel', 'depends_on', 'wait', 'goto_az', 'tol', 'timeout_sec'}
+VALID_WAIT_KEYS = {'query', 'reply_prefix', 'match', 'azimuth', 'tol', 'timeout_sec', 'poll_sec'}
+
+
+class StepFailed(Exception):
+    pass
+
+
+class DomeLink:
+    """
+    Single open connection to the dome controller shared by all running steps.
+
+    A background thread does blocking reads of every line the controller sends so that
+    any number of steps can wait on status replies without polling the port themselves.
+    """
+
+    def __init__(self, ser):
+        self.ser = ser
+        self._write_lock = threading.Lock()
+        self._channel_locks = {ch: threading.Lock() for ch in CHANNELS}
+        self._last_write = {ch: 0.0 for ch in CHANNELS}
+        self._lines = collections.deque(maxlen=LINE_HISTORY_LEN)
+        self._line_count = 0
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+
+    def start(self):
+        self._reader.start()
+
+    def close(self):
+        self._stop.set()
+        self._reader.join()
+
+    def _read_loop(self):
+        while not self._stop.is_set():
+            packet_data = self.ser.readline()  # Blocks for at most ser.timeout
+            if not packet_data:
+                continue
+            # Azimuth reports can carry HC-12 radio noise; keep them so parse_az_line still sees them.
+            line = packet_data.decode("ascii", errors='replace').strip()
+            with self._cond:
+                self._line_count += 1
+                self._lines.append((self._line_count, line))
+                self._cond.notify_all()
+
+    def send(self, cmd: str, channel: str):
+        """
+        Write cmd to the controller, respecting the minimum spacing of its channel.
+
+        Commands are newline-terminated so the firmware's readStringUntil returns
+        immediately instead of waiting out its read timeout.
+        """
+        with self._channel_locks[channel]:
+            gap = CHANNEL_MIN_GAP_SEC[channel] - (time.monotonic() - self._last_write[channel])
+            if gap > 0:
+                time.sleep(gap)
+            with self._write_lock:
+                send_command(self.ser, cmd)
+            self._last_write[channel] = time.monotonic()
+
+    def line_cursor(self):
+        """Return a cursor such that wait_for_line only considers lines received after now."""
+        with self._cond:
+            return self._line_count
+
+    def wait_for_line(self, predicate, cursor, timeout, abort: threading.Event):
+        """
+        Block until a line received after cursor satisfies predicate.
+
+        :return: (matching line or None on timeout/abort, updated cursor)
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                for line_no, line in self._lines:
+                    if line_no > cursor:
+                        cursor = line_no
+                        if predicate(line):
+                            return line, cursor
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or abort.is_set():
+                    return None, cursor
+                self._cond.wait(remaining)
+
+    def wake_waiters(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def query_az(self, abort: threading.Event, listen_timeout=10):
+        """Send RDP and return the azimuth angle in the reply, or None if none arrives."""
+        cursor = self.line_cursor()
+        self.send('RDP', 'relay')
+        line, _ = self.wait_for_line(lambda l: 'RDP' in l and parse_az_line(l) is not None,
+                                     cursor, listen_timeout, abort)
+        if line is None:
+            return None
+        return parse_az_line(line)
+
+
+def step_channel(step):
+    if 'channel' in step:
+        return step['channel']
+    if 'cmd' in step and step['cmd'] in RADIO_COMMANDS:
+        return 'radio'
+    return 'relay'
+
+
+def check_number(owner, key, value, minimum=0, maximum=None):
+    """:raises ValueError: if value is not a number in [minimum, maximum)."""
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"{owner} '{key}' must be a number, not {value!r}")
+    if value < minimum or (maximum is not None and value >= maximum):
+        raise ValueError(f"{owner} '{key}' must satisfy {minimum} <= {key}" + (f" < {maximum}" if maximum else ''))
+
+
+def validate_sequence(name, sequence):
+    """
+    Check that sequence has the form we expect.
+
+    :raises ValueError: if a step is malformed or the dependency graph is not a DAG.
+    """
+    unknown_keys = set(sequence) - VALID_SEQUENCE_KEYS
+    if unknown_keys:
+        raise ValueError(f"sequence '{name}' has unknown keys: {unknown_keys}")
+    if not isinstance(sequence.get('verified', True), bool):
+        raise ValueError(f"sequence '{name}' 'verified' must be true or false")
+    steps = sequence.get('steps')
+    if not steps:
+        raise ValueError(f"sequence '{name}' has no steps")
+    names = [s.get('name') for s in steps]
+    if None in names or len(set(names)) != len(names):
+        raise ValueError(f"sequence '{name}' has missing or duplicate step names: {names}")
+    for step in steps:
+        unknown_keys = set(step) - VALID_STEP_KEYS
+        if unknown_keys:
+            raise ValueError(f"step '{step['name']}' has unknown keys: {unknown_keys}")
+        if ('cmd' in step) == ('goto_az' in step):
+            raise ValueError(f"step '{step['name']}' must have exactly one of 'cmd' or 'goto_az'")
+        if step_channel(step) not in CHANNELS:
+            raise ValueError(f"step '{step['name']}' has invalid channel. Must be one of {CHANNELS}")
+        owner = f"step '{step['name']}'"
+        if 'goto_az' in step:
+            check_number(owner, 'goto_az', step['goto_az'], 0, 360)
+        if 'tol' in step:
+            # The controller reports whole degrees, so a goto_az step can only land within tol >= 1.
+            check_number(owner, 'tol', step['tol'], minimum=1)
+        if 'timeout_sec' in step:
+            check_number(owner, 'timeout_sec', step['timeout_sec'])
+        wait = step.get('wait')
+        if wait is not None:
+            unknown_keys = set(wait) - VALID_WAIT_KEYS
+            if unknown_keys:
+                raise ValueError(f"{owner} wait has unknown keys: {unknown_keys}")
+            if ('match' in wait) == ('azimuth' in wait):
+                raise ValueError(f"{owner} wait must have exactly one of 'match' or 'azimuth'")
+            if 'match' in wait:
+                if 'query' not in wait:
+                    raise ValueError(f"{owner} wait with 'match' must have a 'query'")
+                re.compile(wait['match'])
+            if 'azimuth' in wait:
+                check_number(f"{owner} wait", 'azimuth', wait['azimuth'], 0, 360)
+            for key in ('tol', 'timeout_sec'):
+                if key in wait:
+                    check_number(f"{owner} wait", key, wait[key])
+            if 'poll_sec' in wait:
+                check_number(f"{owner} wait", 'poll_sec', wait['poll_sec'], minimum=0.1)
+        for dep in step.get('depends_on', []):
+            if dep not in names:
+                raise ValueError(f"step '{step['name']}' depends on unknown step '{dep}'")
+    # Every step must eventually become runnable.
+    stages = get_stages(sequence)
+    if sum(len(stage) for stage in stages) != len(steps):
+        raise ValueError(f"sequence '{name}' has a dependency cycle")
+
+
+def get_stages(sequence):
+    """Group step names into stages: every step in a stage only depends on earlier stages."""
+    remaining = {s['name']: set(s.get('depends_on', [])) for s in sequence['steps']}
+    done = set()
+    stages = []
+    while remaining:
+        stage = [n for n, deps in remaining.items() if deps <= done]
+        if not stage:
+            break
+        stages.append(stage)
+        done.update(stage)
+        for n in stage:
+            del remaining[n]
+    return stages
+
+
+def load_sequences(config):
+    with open(config['sequence_file'], 'r') as fp:
+        sequences = json.load(fp)
+    for name, sequence in sequences.items():
+        validate_sequence(name, sequence)
+    return sequences
+
+
+def wait_for_condition(link: DomeLink, wait, abort: threading.Event, cursor):
+    """
+    Block until the status condition described by wait is satisfied.
+
+    If wait has a "query", that command is re-sent every poll_sec seconds until a reply
+    satisfies the condition. A "match" wait only considers replies to the query: lines
+    starting with reply_prefix (the query itself by default). The regex must match the whole
+    rest of the reply after an optional "=", so e.g. "opening" or "not open" do not match "open".
+
+    :raises StepFailed: on timeout or abort.
+    """
+    if 'match' in wait:
+        pattern = re.compile(wait['match'])
+        prefix = wait.get('reply_prefix', wait['query'])
+        predicate = lambda line: (line.startswith(prefix)
+                                  and pattern.fullmatch(line[len(prefix):].strip().lstrip('=').strip()) is not None)
+    else:
+        target, tol = wait['azimuth'], wait.get('tol', 2)
+        predicate = lambda line: (parse_az_line(line) is not None
+                                  and az_distance(parse_az_line(line), target) <= tol)
+    query = wait.get('query')
+    poll_sec = wait.get('poll_sec', DEFAULT_POLL_SEC) if query else float('inf')
+    deadline = time.monotonic() + wait.get('timeout_sec', DEFAULT_WAIT_TIMEOUT_SEC)
+    while not abort.is_set():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise StepFailed(f"timed out waiting for {wait}")
+        if query:
+            link.send(query, 'radio' if query in RADIO_COMMANDS else 'relay')
+        line, cursor = link.wait_for_line(predicate, cursor, min(poll_sec, remaining), abort)
+        if line is not None:
+            return line
+    raise StepFailed('aborted')
+
+
+def confirm_rotation_stopped(link: DomeLink, stop_cmd):
+    """
+    Resend stop_cmd until the dome sends no azimuth reports for STOP_CHECK_SEC after settling.
+
+    Not interrupted by an abort, since it is what makes aborting safe.
+
+    :raises StepFailed: if the dome is still moving after STOP_RETRY_ATTEMPTS retries.
+    """
+    never_abort = threading.Event()
+    for attempt in range(STOP_RETRY_ATTEMPTS + 1):
+        time.sleep(STOP_SETTLE_SEC)
+        cursor = link.line_cursor()
+        line, _ = link.wait_for_line(lambda l: parse_az_line(l) is not None, cursor, STOP_CHECK_SEC, never_abort)
+        if line is None:
+            return
+        print(f'\tWARNING: failed to stop dome rotation ({line}). Retrying...')
+        link.send(stop_cmd, 'relay')
+    raise StepFailed(f'dome still rotating after {STOP_RETRY_ATTEMPTS} stop retries')
+
+
+def do_goto_az(link: DomeLink, step, abort: threading.Event):
+    """
+    Rotate the dome along the shortest arc to step['goto_az'].
+
+    Rotation is stopped ROTATION_COAST_DEG before the target so the dome coasts onto it,
+    confirmed to have stopped, and the final position read back with RDP.
+
+    :raises StepFailed: if the dome rotates away from the target, or the final position is
+        not within step['tol'] of the target.
+    """
+    target_az = step['goto_az']
+    tol = step.get('tol', 2)
+    initial_az = link.query_az(abort)
+    if initial_az is None:
+        raise StepFailed('could not read current azimuth angle')
+    if az_distance(initial_az, target_az) < tol:
+        return initial_az
+    rot_dir = 'right' if arc_length(initial_az, target_az, 'right') < arc_length(initial_az, target_az, 'left') else 'left'
+    start_cmd, stop_cmd = ROTATION_COMMANDS[rot_dir]
+    initial_remaining = arc_length(initial_az, target_az, rot_dir)
+
+    def remaining_deg(az):
+        """Degrees left to rotate; negative once the dome has passed the target."""
+        remaining = arc_length(az, target_az, rot_dir)
+        return remaining - 360 if remaining > 180 else remaining
+
+    def stop_or_wrong_way(line):
+        az = parse_az_line(line)
+        return az is not None and not (ROTATION_COAST_DEG < remaining_deg(az) <= initial_remaining + WRONG_WAY_DEG)
+
+    deadline = time.monotonic() + step.get('timeout_sec', DEFAULT_WAIT_TIMEOUT_SEC)
+    cursor = link.line_cursor()
+    try:
+        link.send(start_cmd, 'relay')
+        line, cursor = link.wait_for_line(stop_or_wrong_way, cursor, deadline - time.monotonic(), abort)
+        if line is None:
+            raise StepFailed('aborted' if abort.is_set() else f'timed out rotating to {target_az}')
+        if remaining_deg(parse_az_line(line)) > initial_remaining:
+            raise StepFailed(f'dome is rotating away from {target_az} ({line}). Check ROTATION_COMMANDS')
+    finally:
+        link.send(stop_cmd, 'relay')
+        confirm_rotation_stopped(link, stop_cmd)
+    final_az = link.query_az(threading.Event())
+    if final_az is None:
+        raise StepFailed('could not read final azimuth angle')
+    if az_distance(final_az, target_az) >= tol:
+        raise StepFailed(f'final azimuth angle {final_az} is not within {tol} deg of {target_az}')
+    return final_az
+
+
+def run_step(link: DomeLink, step, abort: threading.Event):
+    if 'goto_az' in step:
+        return do_goto_az(link, step, abort)
+    cursor = link.line_cursor()
+    link.send(step['cmd'], step_channel(step))
+    if 'wait' in step:
+        return wait_for_condition(link, step['wait'], abort, cursor)
+    return None
+
+
+def run_sequence(link: DomeLink, sequence):
+    """
+    Run every step of sequence, starting each one as soon as all of its dependencies finish.
+
+    :return: True if every step succeeded, False if the sequence was aborted.
+    """
+    steps = sequence['steps']
+    done = set()
+    failures = {}
+    abort = threading.Event()
+    cond = threading.Condition()
+    seq_start = time.monotonic()
+
+    def worker(step):
+        deps = set(step.get('depends_on', []))
+        with cond:
+            cond.wait_for(lambda: abort.is_set() or deps <= done)
+            if abort.is_set():
+                return
+        start = time.monotonic()
+        print(f"\t[{start - seq_start:7.1f}s] {step['name']:<24} started ({step_channel(step)})")
+        try:
+            result = run_step(link, step, abort)
+        except Exception as ex:  # Any error must abort the sequence, not just kill this thread.
+            with cond:
+                failures[step['name']] = ex
+                abort.set()
+                cond.notify_all()
+            link.wake_waiters()
+            print(f"\t[{time.monotonic() - seq_start:7.1f}s] {step['name']:<24} FAILED: {ex}")
+            return
+        end = time.monotonic()
+        reply = f" -> {result}" if result is not None else ""
+        print(f"\t[{end - seq_start:7.1f}s] {step['name']:<24} done in {end - start:.1f}s{reply}")
+        with cond:
+            done.add(step['name'])
+            cond.notify_all()
+
+    threads = [threading.Thread(target=worker, args=(step,), daemon=True) for step in steps]
+    for t in threads:
+        t.start()
+    try:
+        for t in threads:
+            while t.is_alive():
+                t.join(0.5)
+    except KeyboardInterrupt:
+        print('\tInterrupted!')
+        with cond:
+            failures['interrupt'] = KeyboardInterrupt()
+            abort.set()
+            cond.notify_all()
+        link.wake_waiters()
+        for t in threads:
+            t.join()
+
+    if failures:
+        print(f"\tAborting sequence. Sending abort commands: {sequence.get('abort', [])}")
+        for cmd in sequence.get('abort', []):
+            link.send(cmd, 'radio' if cmd in RADIO_COMMANDS else 'relay')
+        return False
+    print(f"\tAll steps finished in {time.monotonic() - seq_start:.1f}s")
+    return True
+
+
+def print_plan(sequence):
+    for i, stage in enumerate(get_stages(sequence)):
+        print(f'\tStage {i + 1}:')
+        for name in stage:
+            step = next(s for s in sequence['steps'] if s['name'] == name)
+            action = step['cmd'] if 'cmd' in step else f"goto az {step['goto_az']}"
+            wait = f", wait for {step['wait']}" if 'wait' in step else ''
+            print(f"\t\t{name:<24} {step_channel(step):<6} {action}{wait}")
+
+
+""" CLI routines"""
+
+
+def do_list(args):
+    sequences = load_sequences(load_config())
+    for name, sequence in sequences.items():
+        unverified = '' if sequence.get('verified', True) else ' (UNVERIFIED)'
+        print(f"{name:<20} {sequence.get('description', '')}{unverified}")
+
+
+def do_run(args):
+    config = load_config()
+    sequences = load_sequences(config)
+    if args.name not in sequences:
+        raise ValueError(f"Unknown sequence '{args.name}'. Choose from {list(sequences)}")
+    sequence = sequences[args.name]
+    print(f"Sequence '{args.name}': {sequence.get('description', '')}")
+    print_plan(sequence)
+    if args.dry_run:
+        return
+    if not sequence.get('verified', True) and not args.unverified:
+        print(f"Sequence '{args.name}' is not verified against the controller's replies. "
+              f"Rerun with --unverified to run it anyway.")
+        return
+    start_time = datetime.datetime.now(datetime.timezone.utc)
+    print(f"Started at \t{start_time}")
+    with open_dome_connection(config) as ser:
+        if isinstance(ser, serial.Serial):
+            time.sleep(PORT_SETTLE_SEC)
+        ser.reset_input_buffer()
+        link = DomeLink(ser)
+        link.start()
+        try:
+            success = run_sequence(link, sequence)
+        finally:
+            link.close()
+    print(f"Sequence '{args.name}' {'completed' if success else 'FAILED'}")
+
+
+def sequence_cli_main():
+    parser = argparse.ArgumentParser(description="Run named Crocker dome command sequences.")
+    subparsers = parser.add_subparsers(required=True)
+
+    parser_list = subparsers.add_parser('list', description='List available sequences')
+    parser_list.set_defaults(func=do_list)
+
+    parser_run = subparsers.add_parser('run', description='Run a sequence')
+    parser_run.add_argument('name', help='Name of the sequence to run.')
+    parser_run.add_argument('--dry-run', action='store_true', help='Print the execution plan without sending commands.')
+    parser_run.add_argument('--unverified', action='store_true', help='Allow running sequences marked "verified": false.')
+    parser_run.set_defaults(func=do_run)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sequence_cli_main()